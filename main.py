@@ -23,13 +23,15 @@
 import sys
 import os
 import argparse
-import atexit
+import fcntl
 import requests
 import subprocess
 import time
+import random
 import logging
 import hashlib
-import shutil
+import filecmp
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -76,6 +78,19 @@ except KeyError as e:
     logger.error("Environment variables not set correctly")
     error_exit(1, f"Environment variable error: {e}", "None set")
 
+# Share one session between the IXP Manager calls so the connection is reused
+SESSION = requests.Session()
+SESSION.headers.update({"X-IXP-Manager-API-Key": API_KEY})
+
+# Marker for the BGP protocol definitions a valid config must contain
+BGP_MARKER = b"protocol bgp pb_"
+
+# Seconds to wait for a bird/birdc command before killing it
+SUBPROCESS_TIMEOUT = 30
+
+# How many times to try telling IXP Manager that the router has been updated
+INFORM_ATTEMPTS = 8
+
 
 # Parse command line arguments
 def parse_args():
@@ -83,6 +98,12 @@ def parse_args():
     parser.add_argument("-d", "--debug", action="store_true", help="Enable debug mode")
     parser.add_argument("-f", "--force", action="store_true", help="Force reload")
     parser.add_argument("-H", "--handle", type=str, help="Router handle", required=True)
+    parser.add_argument(
+        "-s",
+        "--strict",
+        action="store_true",
+        help="Treat changes to comments as config changes",
+    )
 
     args = parser.parse_args()
     return args
@@ -91,56 +112,82 @@ def parse_args():
 # Create necessary directories for Bird
 def create_directories(handle):
     try:
-        os.makedirs(ETC_PATH, exist_ok=True)
-        os.makedirs(LOG_PATH, exist_ok=True)
-        os.makedirs(RUN_PATH, exist_ok=True)
-        os.makedirs(LOCK_PATH, exist_ok=True)
+        for path in (ETC_PATH, LOG_PATH, RUN_PATH, LOCK_PATH):
+            if not os.path.isdir(path):
+                os.makedirs(path, exist_ok=True)
     except OSError as e:
         logger.error("Could not create directories most likely due to permissions")
         error_exit(2, e, "None set")
 
 
 # Only allow one instance of the script to run at a time - script locking
-def remove_lock(lock):
-    if os.path.exists(lock):
-        os.remove(lock)
-
-
+# The kernel releases the lock when the process exits, however it exits
 def create_lock(lock, handle):
-    if os.path.exists(lock):
+    lock_fd = os.open(lock, os.O_CREAT | os.O_RDWR, 0o644)
+    try:
+        fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
         logger.info(
             f"There is another instance running for {handle} and locked via {lock}, exiting"
         )
         sys.exit(1)
-    else:
-        process_id = os.getpid()
-        with open(lock, "w") as file:
-            file.write(str(process_id))
-        atexit.register(remove_lock, lock)
+
+    os.ftruncate(lock_fd, 0)
+    os.write(lock_fd, str(os.getpid()).encode())
+    return lock_fd
 
 
 # Get a lock from IXP Manager to update the router
-def get_lock(handle, headers):
-    logger.debug(f"POST {URL_LOCK}/{handle} with API key {API_KEY}")
+def get_lock(urls, handle):
+    logger.debug(f"POST {urls['lock']} with API key {API_KEY}")
 
     try:
-        response = requests.post(f"{URL_LOCK}/{handle}", headers=headers)
+        response = SESSION.post(urls["lock"])
         response.raise_for_status()
     except requests.exceptions.HTTPError as e:
         logger.error("ABORTING: router not available for update")
         error_exit(200, e, handle)
 
 
+# Read the ETag saved for the config last applied, if any
+def read_etag(etag_file):
+    try:
+        with open(etag_file, "r") as file:
+            return file.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+# Save the ETag of the config just applied, or forget it if there wasn't one
+def save_etag(etag_file, etag):
+    if etag:
+        with open(etag_file, "w") as file:
+            file.write(etag)
+    elif os.path.exists(etag_file):
+        os.remove(etag_file)
+
+
 # Get the config from the IXP Manager
-def get_config(handle, dest, headers):
-    logger.debug(f"GET {URL_CONF}/{handle} with API key {API_KEY}")
+# Returns whether a new config was written to dest, and its ETag
+def get_config(urls, handle, dest, etag=None):
+    logger.debug(f"GET {urls['conf']} with API key {API_KEY}")
 
+    headers = {"If-None-Match": etag} if etag else {}
     try:
-        response = requests.get(f"{URL_CONF}/{handle}", headers=headers)
-        response.raise_for_status()
+        with SESSION.get(urls["conf"], headers=headers, stream=True) as response:
+            if response.status_code == 304:
+                logger.info("Config not modified since last update")
+                return False, etag
+
+            response.raise_for_status()
 
-        with open(dest, "w") as file:
-            file.write(response.text)
+            with open(dest, "wb") as file:
+                for chunk in response.iter_content(chunk_size=65536):
+                    file.write(chunk)
+                file.flush()
+                os.fsync(file.fileno())
+
+            return True, response.headers.get("ETag")
 
     except requests.exceptions.HTTPError as e:
         logger.error(f"Non-zero return from curl when generating {dest}")
@@ -151,80 +198,126 @@ def get_config(handle, dest, headers):
         error_exit(3, e, handle)
 
 
-# Check if the generated file is valid
-def is_valid_file(dest, handle):
-    if not os.path.exists(dest) or not os.path.getsize(dest):
+# Read a config file once, returning its size, the number of BGP protocol
+# definitions (counting stops at 2) and a hash of it with comments and blank
+# lines filtered out (None when with_hash is False)
+def scan_config(file_path, with_hash=True):
+    bgp_count = 0
+    file_hash = hashlib.blake2b(digest_size=16) if with_hash else None
+    with open(file_path, "rb") as file:
+        file_size = os.fstat(file.fileno()).st_size
+        for line in file:
+            if bgp_count < 2:
+                bgp_count += line.count(BGP_MARKER)
+            if file_hash is not None:
+                stripped = line.lstrip()
+                if stripped and not stripped.startswith(b"#"):
+                    file_hash.update(line)
+            # Without a hash to build there is nothing left to read
+            elif bgp_count >= 2:
+                break
+    return file_size, bgp_count, file_hash.digest() if file_hash is not None else None
+
+
+# Check if the generated file is valid and return its filtered hash
+def is_valid_file(dest, handle, with_hash=True):
+    try:
+        dest_size, bgp_count, dest_hash = scan_config(dest, with_hash)
+    except FileNotFoundError:
+        dest_size = 0
+    if not dest_size:
         logger.error(f"{dest} does not exist or is zero size")
         error_exit(3, f"File {dest} is invalid", handle)
 
-    with open(dest, "r") as file:
-        contents = file.read()
-        bgp_count = contents.count("protocol bgp pb_")
-        if bgp_count < 2:
-            logger.error(
-                f"Fewer than 2 BGP protocol definitions in config file {dest} - something has gone wrong..."
-            )
-            error_exit(4, "Less than 2 'protocol bgp pb_' definitions found", handle)
+    if bgp_count < 2:
+        logger.error(
+            f"Fewer than 2 BGP protocol definitions in config file {dest} - something has gone wrong..."
+        )
+        error_exit(4, "Less than 2 'protocol bgp pb_' definitions found", handle)
+
+    return dest_hash
 
 
 # Parse and check the config file
 def parse_config(dest, handle):
-    command = f"{BIRD_BIN} -p -c {dest}"
+    command = [BIRD_BIN, "-p", "-c", dest]
     logger.debug(f"Checking config file {dest} for errors")
     try:
-        subprocess.run(command, check=True, capture_output=True, shell=True)
+        subprocess.run(
+            command, check=True, capture_output=True, timeout=SUBPROCESS_TIMEOUT
+        )
     except subprocess.CalledProcessError as e:
         logger.error(f"Non-zero return from {BIRD_BIN} when parsing {dest}")
         error_exit(7, e, handle)
+    except subprocess.TimeoutExpired as e:
+        logger.error(f"Timed out waiting for {BIRD_BIN} to parse {dest}")
+        error_exit(7, e, handle)
 
 
 # Apply config and start Bird if needed
-# Filter out the comments from the given file
-def filter_comments(file_path):
-    filtered_file = ""
-    with open(file_path, "r") as file:
-        lines = file.readlines()
-        for line in lines:
-            if not line.strip().startswith("#"):
-                filtered_file += line
-        return filtered_file
+# Move the new config into place and make sure the rename survives a crash
+def commit_config(dest, cfile):
+    os.replace(dest, cfile)
+    dir_fd = os.open(os.path.dirname(cfile), os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+# Filtered hash of the current config, or None if there isn't one yet
+def current_config_hash(cfile):
+    try:
+        return scan_config(cfile)[2]
+    except FileNotFoundError:
+        return None
 
 
 # USE HASH INSTEAD OF COMPARING LINES ITS QUICKER
-def detect_change(cfile, dest):
+# In strict mode comments matter, so a plain byte compare is enough and it
+# bails out early on a size mismatch without reading either file
+# Both hashes are computed up front so neither file is read again here
+def detect_change(cfile, dest, cfile_hash, dest_hash, strict=False):
     if os.path.exists(cfile):
-        cfile_filtered = filter_comments(cfile)
-        dest_filtered = filter_comments(dest)
-
-        cfile_hash = hashlib.sha256(cfile_filtered.encode("utf-8")).hexdigest()
-        dest_hash = hashlib.sha256(dest_filtered.encode("utf-8")).hexdigest()
+        if strict:
+            unchanged = filecmp.cmp(cfile, dest, shallow=False)
+        else:
+            unchanged = cfile_hash == dest_hash
 
-        if cfile_hash == dest_hash:
+        if unchanged:
             logger.info("No changes detected")
             os.remove(dest)
             return 0
         else:
-            shutil.copyfile(cfile, f"{cfile}.old")
-            os.rename(dest, cfile)
+            # Hard link the backup rather than copying it, the rename below
+            # then points cfile at the new inode and leaves the old one
+            try:
+                os.unlink(f"{cfile}.old")
+            except FileNotFoundError:
+                pass
+            os.link(cfile, f"{cfile}.old")
+            commit_config(dest, cfile)
             return 1
     else:
-        os.rename(dest, cfile)
+        commit_config(dest, cfile)
         return 1
 
 
 # Does the Bird daemon need to be started
 # Couldn't find a pythonic way to do this, so using subprocess
-def revert_config(dest, cfile, socket, handle):
+def revert_config(dest, cfile, birdc_argv, handle):
     if os.path.exists(f"{cfile}.old"):
         logger.info("Trying to revert to previous")
-        shutil.move(f"{cfile}.conf", f"{dest}.failed")
-        shutil.move(f"{cfile}.old", cfile)
-        command = f"{BIRD_BIN}c -s {socket} configure"
-        logger.debug(command)
+        # The saved ETag describes the config being reverted, not the backup
+        save_etag(f"{cfile}.etag", None)
+        os.replace(cfile, f"{dest}.failed")
+        os.replace(f"{cfile}.old", cfile)
+        command = birdc_argv + ["configure"]
+        logger.debug(" ".join(command))
         try:
-            subprocess.run(command, check=True, shell=True)
+            subprocess.run(command, check=True, timeout=SUBPROCESS_TIMEOUT)
             logger.info("Successfully reverted")
-        except subprocess.CalledProcessError as e:
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
             logger.error("Revert failed due to subprocess error")
             error_exit(6, e, handle)
         except IOError as e:
@@ -232,32 +325,43 @@ def revert_config(dest, cfile, socket, handle):
             error_exit(6, e, handle)
 
 
-def reload_if_needed(socket, cfile, reload_required, dest, handle):
-    command = f"{BIRD_BIN}c -s {socket} show status"
-    result = subprocess.run(command, capture_output=True, shell=True)
+def reload_if_needed(birdc_argv, socket, cfile, reload_required, dest, handle):
+    command = birdc_argv + ["show", "status"]
+    try:
+        result = subprocess.run(
+            command,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            timeout=SUBPROCESS_TIMEOUT,
+        )
+    except subprocess.TimeoutExpired as e:
+        logger.error(f"Timed out checking the status of {BIRD_BIN} via {socket}")
+        error_exit(5, e, handle)
 
-    logger.debug(command)
+    logger.debug(" ".join(command))
 
     # Unsuccesful command run
     if result.returncode != 0:
-        command = f"{BIRD_BIN} -c {cfile} -s {socket}"
-        logger.debug(command)
+        command = [BIRD_BIN, "-c", cfile, "-s", socket]
+        logger.debug(" ".join(command))
         try:
-            subprocess.run(command, check=True, shell=True)
-        except subprocess.CalledProcessError as e:
-            logger.error(f"Could not start {BIRD_BIN} daemon with command: {command}")
+            subprocess.run(command, check=True, timeout=SUBPROCESS_TIMEOUT)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            logger.error(
+                f"Could not start {BIRD_BIN} daemon with command: {' '.join(command)}"
+            )
             error_exit(5, e, handle)
 
     # Successful command run
     elif reload_required:
         try:
-            command = f"{BIRD_BIN}c -s {socket} configure"
-            logger.info(command)
-            subprocess.run(command, check=True, shell=True)
+            command = birdc_argv + ["configure"]
+            logger.info(" ".join(command))
+            subprocess.run(command, check=True, timeout=SUBPROCESS_TIMEOUT)
 
         # Try to revert to the previous config
-        except subprocess.CalledProcessError as e:
-            revert_config(dest, cfile, socket, handle)
+        except (subprocess.CalledProcessError, subprocess.TimeoutExpired) as e:
+            revert_config(dest, cfile, birdc_argv, handle)
             logger.error(f"Reconfigure failed for {dest}")
             error_exit(6, e, handle)
 
@@ -265,21 +369,30 @@ def reload_if_needed(socket, cfile, reload_required, dest, handle):
 
 
 # Tell IXP manager that the router has been updated
-def inform_ixp_manager(handle, headers):
-    logger.debug(f"POST {URL_LOCK}/{handle} with API key {API_KEY}")
+def inform_ixp_manager(urls, handle):
+    logger.debug(f"POST {urls['done']} with API key {API_KEY}")
 
-    inform_success = False
-    while not inform_success:
+    # Back off exponentially with jitter, capped at 60 seconds, and give up
+    # after INFORM_ATTEMPTS so an outage cannot hold the lock forever
+    for attempt in range(INFORM_ATTEMPTS):
         try:
-            response = requests.post(f"{URL_DONE}/{handle}", headers=headers)
+            response = SESSION.post(urls["done"])
             response.raise_for_status()
-            inform_success = True
-        except requests.exceptions.HTTPError as e:
+            return
+        except requests.exceptions.RequestException as e:
+            logger.error(f"HTTP error: {e}")
+            if attempt == INFORM_ATTEMPTS - 1:
+                break
+            delay = min(60, 2**attempt) + random.random()
             logger.warning(
-                f"Could not inform IXP Manager of update for {handle}, retrying in 60 seconds"
+                f"Could not inform IXP Manager of update for {handle}, retrying in {delay:.0f} seconds"
             )
-            logger.error(f"HTTP error: {e}")
-            time.sleep(60)
+            time.sleep(delay)
+
+    logger.error(f"Giving up informing IXP Manager of update for {handle}")
+    error_exit(
+        8, f"Could not inform IXP Manager after {INFORM_ATTEMPTS} attempts", handle
+    )
 
 
 def main():
@@ -292,32 +405,68 @@ def main():
     if args.force:
         force_reload = 1
     handle = args.handle
+    strict = args.strict
 
     create_directories(handle)
     cfile = f"{ETC_PATH}/bird-{handle}.conf"
     dest = f"{cfile}.$$"
     socket = f"{RUN_PATH}/bird-{handle}.ctl"
+    etag_file = f"{cfile}.etag"
+
+    # Build the per-handle URLs and birdc command prefix once
+    urls = {
+        "lock": f"{URL_LOCK}/{handle}",
+        "conf": f"{URL_CONF}/{handle}",
+        "done": f"{URL_DONE}/{handle}",
+    }
+    birdc_argv = [f"{BIRD_BIN}c", "-s", socket]
 
     # Prevent multiple instances of the script running at the same time
     lock = f"{LOCK_PATH}/{handle}.lock"
     create_lock(lock, handle)
 
-    headers = {"X-IXP-Manager-API-Key": API_KEY}
-    get_lock(handle, headers)
+    get_lock(urls, handle)
 
-    get_config(handle, dest, headers)
-    is_valid_file(dest, handle)
-    parse_config(dest, handle)
+    # Only offer the saved ETag if the config it describes is still there
+    etag = read_etag(etag_file) if os.path.exists(cfile) else None
+    config_modified, etag = get_config(urls, handle, dest, etag)
 
-    # Config file is valid if this point is reached
-    reload_required = detect_change(cfile, dest)
+    if config_modified:
+        # Strict mode compares the raw files, so neither needs hashing
+        if strict:
+            is_valid_file(dest, handle, with_hash=False)
+            parse_config(dest, handle)
+            cfile_hash = dest_hash = None
+        else:
+            dest_hash = is_valid_file(dest, handle)
+
+            # Hash the current config while waiting on the bird -p subprocess
+            with ThreadPoolExecutor(max_workers=1) as executor:
+                cfile_future = executor.submit(current_config_hash, cfile)
+                parse_config(dest, handle)
+            cfile_hash = cfile_future.result()
+
+        # Config file is valid if this point is reached
+        # cfile may be replaced below, so drop the saved ETag first to make
+        # sure it can never describe a config other than the one in cfile
+        save_etag(etag_file, None)
+        reload_required = detect_change(cfile, dest, cfile_hash, dest_hash, strict)
+    else:
+        reload_required = 0
     if force_reload:
         reload_required = 1
     logger.debug(f"Show memory usage of each instance of {BIRD_BIN}")
 
-    reload_if_needed(socket, cfile, reload_required, dest, handle)
+    reload_if_needed(birdc_argv, socket, cfile, reload_required, dest, handle)
     # Inform IXP Manager that the router has been updated and release the lock
-    inform_ixp_manager(handle, headers)
+    inform_ixp_manager(urls, handle)
+
+    # Only remember the ETag once Bird is running with the config it describes
+    if config_modified:
+        try:
+            save_etag(etag_file, etag)
+        except OSError as e:
+            logger.warning(f"Could not save ETag to {etag_file}: {e}")
     sys.exit(0)
 
 